@@ -2,13 +2,19 @@
 
 import os
 import sys
-import json
+import time
+import atexit
 import base64
-import urllib.request
+import logging
+import threading
 import urllib.parse
+import httpx
+import orjson
 import streamlit as st
 import streamlit.components.v1 as components
 
+logger = logging.getLogger(__name__)
+
 # -----------------------------------------------------------------------------
 # Config
 # -----------------------------------------------------------------------------
@@ -22,6 +28,12 @@ CONFIG = {
     "workspace_id": os.environ.get("WORKSPACE_ID"),
 }
 
+def _check_config():
+    missing = [k for k, v in CONFIG.items() if not v]
+    if missing:
+        st.error(f"Missing config values: {', '.join(missing)}")
+        st.stop()
+
 basic_auth = base64.b64encode(
     f"{CONFIG['service_principal_id']}:{CONFIG['service_principal_secret']}".encode()
 ).decode()
@@ -29,76 +41,245 @@ basic_auth = base64.b64encode(
 # -----------------------------------------------------------------------------
 # HTTP Request Helper
 # -----------------------------------------------------------------------------
+@st.cache_resource
+def _get_http_client():
+    # One keep-alive pool for every call to the Databricks host, instead of a
+    # new TCP + TLS handshake per request. HTTP/2 also compresses the repeated
+    # Authorization headers. Redirects are followed like urlopen did.
+    client = httpx.Client(
+        http2=True,
+        follow_redirects=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+        timeout=10.0,
+    )
+    atexit.register(client.close)
+    return client
+
 def http_request(url, method="GET", headers=None, body=None):
     headers = headers or {}
     if body is not None and not isinstance(body, (bytes, str)):
         raise ValueError("Body must be bytes or str")
 
-    req = urllib.request.Request(url, method=method, headers=headers)
-    if body is not None:
-        if isinstance(body, str):
-            body = body.encode()
-        req.data = body
+    if isinstance(body, str):
+        body = body.encode()
 
-    with urllib.request.urlopen(req) as resp:
-        data = resp.read().decode()
-        try:
-            return {"data": json.loads(data)}
-        except json.JSONDecodeError:
-            return {"data": data}
+    resp = _get_http_client().request(method, url, headers=headers, content=body)
+    resp.raise_for_status()
+    try:
+        return {"data": orjson.loads(resp.content)}
+    except orjson.JSONDecodeError:
+        return {"data": resp.text}
 
 # -----------------------------------------------------------------------------
 # Token logic
 # -----------------------------------------------------------------------------
+# Refresh cached tokens this many seconds before they actually expire.
+TOKEN_EXPIRY_MARGIN = 60
+# Assumed lifetime when a token response has no expires_in; Databricks OAuth
+# access tokens are valid for one hour.
+DEFAULT_TOKEN_LIFETIME = 3600
+# The scoped-token request body is built from the published tokeninfo, which is
+# configuration-like, so it is kept much longer.
+SCOPED_TOKEN_BODY_TTL = 3600
+# The background refresher renews the scoped token once this fraction of its
+# remaining lifetime has passed, and waits at least TOKEN_REFRESH_RETRY seconds
+# between attempts, doubling after each failure up to TOKEN_REFRESH_MAX_RETRY.
+TOKEN_REFRESH_FRACTION = 0.8
+TOKEN_REFRESH_RETRY = 30
+TOKEN_REFRESH_MAX_RETRY = 600
+
+@st.cache_resource
+def _get_oidc_request():
+    # The token endpoint headers and client-credentials body never change, so
+    # they are built on the first token request and reused afterwards.
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded",
+        "Authorization": f"Basic {basic_auth}",
+    }
+    client_credentials_body = urllib.parse.urlencode({
+        "grant_type": "client_credentials",
+        "scope": "all-apis"
+    }).encode()
+    return headers, client_credentials_body
+
+@st.cache_resource
+def _get_token_state():
+    # Streamlit re-executes this module on every rerun, so the token caches have
+    # to live in a cached resource to be shared across reruns and sessions.
+    # Apart from the unlocked fast path in get_scoped_token, the caches are only
+    # touched while holding "lock". The key and URLs derived from the (fixed)
+    # config are built here too, once main() has validated it.
+    instance_url = CONFIG["instance_url"]
+    return {
+        "token_key": (
+            CONFIG["dashboard_id"], CONFIG["external_viewer_id"], CONFIG["external_value"]
+        ),
+        "oidc_token_url": f"{instance_url}/oidc/v1/token",
+        "token_info_url": (
+            f"{instance_url}/api/2.0/lakeview/dashboards/"
+            f"{CONFIG['dashboard_id']}/published/tokeninfo"
+            f"?external_viewer_id={urllib.parse.quote(CONFIG['external_viewer_id'])}"
+            f"&external_value={urllib.parse.quote(CONFIG['external_value'])}"
+        ),
+        "lock": threading.Lock(),
+        "scoped_tokens": {},
+        "scoped_token_bodies": {},
+        "oidc_token": {},
+        "refresher": None,
+    }
+
 def get_scoped_token():
-    oidc_res = http_request(
-        f"{CONFIG['instance_url']}/oidc/v1/token",
+    state = _get_token_state()
+    key = state["token_key"]
+    cache = state["scoped_tokens"]
+
+    entry = cache.get(key)
+    if entry and time.monotonic() < entry[1] - TOKEN_EXPIRY_MARGIN:
+        return entry[0]
+
+    with state["lock"]:
+        entry = cache.get(key)
+        if entry and time.monotonic() < entry[1] - TOKEN_EXPIRY_MARGIN:
+            return entry[0]
+
+        token = _refresh_token(state, key)
+
+        if state["refresher"] is None:
+            # Keeps the cache warm so page loads never wait on a token refresh.
+            state["refresher"] = threading.Thread(
+                target=_token_refresher, args=(state, key), daemon=True
+            )
+            state["refresher"].start()
+    return token
+
+def _refresh_token(state, key):
+    # Caller must hold the state lock.
+    token, expires_in = _fetch_scoped_token(state, key)
+    state["scoped_tokens"][key] = (token, time.monotonic() + expires_in, expires_in)
+    return token
+
+def _token_refresher(state, key):
+    # Runs until its state is no longer the cached one, e.g. after the resource
+    # cache is cleared; get_scoped_token then starts a refresher for the new state.
+    lock, cache = state["lock"], state["scoped_tokens"]
+    failures = 0
+    while True:
+        seen = cache.get(key)
+        remaining = seen[1] - time.monotonic() if seen else 0
+        retry = min(TOKEN_REFRESH_RETRY * 2 ** min(failures, 5), TOKEN_REFRESH_MAX_RETRY)
+        time.sleep(max(remaining * TOKEN_REFRESH_FRACTION, retry))
+        if _get_token_state() is not state:
+            return
+        try:
+            with lock:
+                # get_scoped_token may have refreshed on demand while we slept.
+                entry = cache.get(key)
+                fresh = entry is not None and entry is not seen and (
+                    entry[1] - time.monotonic() > (1 - TOKEN_REFRESH_FRACTION) * entry[2]
+                )
+                if not fresh:
+                    _refresh_token(state, key)
+            failures = 0
+        except Exception:
+            failures += 1
+            logger.exception(
+                "Background token refresh failed (%d consecutive failures)", failures
+            )
+
+def _token_lifetime(data):
+    if "expires_in" not in data:
+        logger.warning(
+            "Token response has no expires_in; assuming %d seconds",
+            DEFAULT_TOKEN_LIFETIME,
+        )
+        return DEFAULT_TOKEN_LIFETIME
+    return int(data["expires_in"])
+
+def _request_oidc_token(state, body):
+    return http_request(
+        state["oidc_token_url"],
         method="POST",
-        headers={
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {basic_auth}",
-        },
-        body=urllib.parse.urlencode({
-            "grant_type": "client_credentials",
-            "scope": "all-apis"
-        })
-    )
-    oidc_token = oidc_res["data"]["access_token"]
+        headers=_get_oidc_request()[0],
+        body=body
+    )["data"]
+
+def _get_oidc_token(state):
+    # The service principal token is independent of the viewer, and outlives
+    # the scoped tokens and tokeninfo built from it.
+    cache = state["oidc_token"]
+    if cache and time.monotonic() < cache["expires_at"] - TOKEN_EXPIRY_MARGIN:
+        return cache["access_token"]
+
+    data = None
+    refresh_token = cache.get("refresh_token")
+    if refresh_token:
+        try:
+            data = _request_oidc_token(state, urllib.parse.urlencode({
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token
+            }))
+        except httpx.HTTPStatusError:
+            data = None
+    if not isinstance(data, dict) or "access_token" not in data:
+        # No refresh token, or it did not yield an access token; drop it rather
+        # than retrying it on every renewal.
+        refresh_token = None
+        data = _request_oidc_token(state, _get_oidc_request()[1])
+
+    cache.update({
+        "access_token": data["access_token"],
+        "expires_at": time.monotonic() + _token_lifetime(data),
+        # The server may omit a new refresh token (RFC 6749 section 6), in
+        # which case the current one stays valid.
+        "refresh_token": data.get("refresh_token") or refresh_token,
+    })
+    return data["access_token"]
+
+def _get_scoped_token_body(state, key):
+    # Caches the encoded scoped-token request built from tokeninfo, so the
+    # parsed tokeninfo dict is owned here and can be reshaped in place.
+    cache = state["scoped_token_bodies"]
+    entry = cache.get(key)
+    if entry and time.monotonic() < entry[1]:
+        return entry[0]
+
+    oidc_token = _get_oidc_token(state)
 
-    token_info_url = (
-        f"{CONFIG['instance_url']}/api/2.0/lakeview/dashboards/"
-        f"{CONFIG['dashboard_id']}/published/tokeninfo"
-        f"?external_viewer_id={urllib.parse.quote(CONFIG['external_viewer_id'])}"
-        f"&external_value={urllib.parse.quote(CONFIG['external_value'])}"
-    )
     token_info = http_request(
-        token_info_url,
+        state["token_info_url"],
         headers={"Authorization": f"Bearer {oidc_token}"}
     )["data"]
 
-    params = token_info.copy()
-    authorization_details = params.pop("authorization_details", None)
-    params.update({
-        "grant_type": "client_credentials",
-        "authorization_details": json.dumps(authorization_details)
-    })
+    authorization_details = token_info.pop("authorization_details", None)
+    token_info["grant_type"] = "client_credentials"
+    token_info["authorization_details"] = orjson.dumps(authorization_details)
+    body = urllib.parse.urlencode(token_info).encode()
 
-    scoped_res = http_request(
-        f"{CONFIG['instance_url']}/oidc/v1/token",
-        method="POST",
-        headers={
-            "Content-Type": "application/x-www-form-urlencoded",
-            "Authorization": f"Basic {basic_auth}",
-        },
-        body=urllib.parse.urlencode(params)
-    )
-    return scoped_res["data"]["access_token"]
+    cache[key] = (body, time.monotonic() + SCOPED_TOKEN_BODY_TTL)
+    return body
+
+def _fetch_scoped_token(state, key):
+    # The OIDC token is only needed to read tokeninfo, so a cached request body
+    # leaves a single round trip here.
+    body = _get_scoped_token_body(state, key)
+
+    try:
+        scoped_data = _request_oidc_token(state, body)
+    except httpx.HTTPStatusError:
+        # The body may be stale (e.g. the dashboard was republished), so rebuild
+        # it from fresh tokeninfo on the next attempt.
+        state["scoped_token_bodies"].pop(key, None)
+        raise
+    return scoped_data["access_token"], _token_lifetime(scoped_data)
 
 # -----------------------------------------------------------------------------
 # HTML generator
 # -----------------------------------------------------------------------------
-def generate_html(token):
-    return f"""<!DOCTYPE html>
+_TOKEN_PLACEHOLDER = "__SCOPED_TOKEN__"
+
+# Everything but the token is fixed, so the page is formatted once per run and
+# split around the token.
+_HTML_PREFIX, _HTML_SUFFIX = f"""<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
@@ -117,7 +298,7 @@ def generate_html(token):
             instanceUrl: "{CONFIG['instance_url']}",
             workspaceId: "{CONFIG['workspace_id']}",
             dashboardId: "{CONFIG['dashboard_id']}",
-            token: "{token}",
+            token: "{_TOKEN_PLACEHOLDER}",
             container: document.getElementById("dashboard-content")
         }});
         dashboard.initialize();
@@ -130,7 +311,10 @@ def generate_html(token):
   frameborder="0">
 </iframe>
 </body>
-</html>"""
+</html>""".split(_TOKEN_PLACEHOLDER)
+
+def generate_html(token):
+    return _HTML_PREFIX + token + _HTML_SUFFIX
 
 # -----------------------------------------------------------------------------
 # Streamlit app
@@ -154,10 +338,7 @@ def main():
     """,
     unsafe_allow_html=True)
     
-    missing = [k for k, v in CONFIG.items() if not v]
-    if missing:
-        st.error(f"Missing config values: {', '.join(missing)}")
-        st.stop()
+    _check_config()
 
     st.title("📊 Databricks Dashboard Embed")
 